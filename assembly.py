@@ -315,7 +315,8 @@ def refine_assembly(inFasta, inBam, outFasta,
     novoBam = util.file.mkstempfname('.novoalign.bam')
     min_qual = 0 if keep_all_reads else 1
     novoalign.execute(inBam, inFasta, novoBam,
-        options=novo_params.split(), min_qual=min_qual, JVMmemory=JVMmemory)
+        options=novo_params.split(), min_qual=min_qual, JVMmemory=JVMmemory,
+        create_index=False)
     rmdupBam = util.file.mkstempfname('.rmdup.bam')
     opts = ['CREATE_INDEX=true']
     if not keep_all_reads:
@@ -8,18 +8,23 @@ __commands__ = []
 
 import Bio.AlignIO
 from Bio import SeqIO
-import argparse, logging, os, array, bisect
+import argparse, logging, os, re, array, bisect, multiprocessing, shutil, tempfile
 
 try:
     from itertools import zip_longest
 except ImportError :
     from itertools import izip_longest as zip_longest
 import tools.muscle, tools.snpeff, tools.mafft
-import util.cmd, util.file, util.vcf
-from collections import OrderedDict, Sequence
+import util.cmd, util.file, util.misc, util.vcf
+try:
+    from collections.abc import Sequence
+except ImportError :
+    from collections import Sequence
 
 log = logging.getLogger(__name__)
 
+GAP_RUN_RE = re.compile('-+')
+
 # =========== CoordMapper =================
 
 class CoordMapper(object):
@@ -40,8 +45,8 @@ class CoordMapper(object):
         """ The two genomes are described by fasta files with the same number of 
             chromosomes, and corresponding chromosomes must be in same order.
         """
-        self.AtoB = OrderedDict() # {chrA : [chrB, mapperAB], chrC : [chrD, mapperCD], ...}
-        self.BtoA = OrderedDict() # {chrB : [chrA, mapperAB], chrD : [chrC, mapperCD], ...}
+        self.AtoB = {} # {chrA : [chrB, mapperAB], chrC : [chrD, mapperCD], ...}
+        self.BtoA = {} # {chrB : [chrA, mapperAB], chrD : [chrC, mapperCD], ...}
         
         self._align(fastaA, fastaB, alignerTool())
 
@@ -78,22 +83,26 @@ class CoordMapper(object):
         return (toChrom, toPos)
 
     def _align(self, fastaA, fastaB, aligner) :
-        # transpose
-        per_chr_fastas = transposeChromosomeFiles([fastaA, fastaB])
-        if not per_chr_fastas:
-            raise Exception('no input sequences')
-        # align
-        alignOutFileNames = []
-        for alignInFileName in per_chr_fastas:
-            alignOutFileName = util.file.mkstempfname('.fasta')
-            aligner.execute(alignInFileName, alignOutFileName)
-            alignOutFileNames.append(alignOutFileName)
-            os.unlink(alignInFileName)
-        # read in
-        self._load_alignments(alignOutFileNames)
-        # clean up
-        for f in alignOutFileNames:
-            os.unlink(f)
+        # Keep all of this mapper's intermediate files in one temp directory
+        # so they can be removed together, even if an alignment fails.
+        alignDir = tempfile.mkdtemp(prefix='coordmapper-')
+        try:
+            # transpose
+            per_chr_fastas = transposeChromosomeFiles([fastaA, fastaB], outputDir=alignDir)
+            if not per_chr_fastas:
+                raise Exception('no input sequences')
+            # align each chromosome concurrently, one aligner process apiece
+            aligner.install_and_get_path()
+            def align_one(alignInFileName):
+                alignOutFileName = alignInFileName[:-len('.fasta')] + '.aligned.fasta'
+                aligner.execute(alignInFileName, alignOutFileName)
+                return alignOutFileName
+            alignOutFileNames = util.misc.parallel_map(align_one, per_chr_fastas)
+            # read in
+            self._load_alignments(alignOutFileNames)
+        finally:
+            # clean up
+            shutil.rmtree(alignDir)
     
     def _load_alignments(self, aligned_files, a_idx=0, b_idx=1) :
         assert a_idx>=0 and b_idx>=0
@@ -136,34 +145,36 @@ class CoordMapper2Seqs(object) :
     """
     
     def __init__(self, seq0, seq1) :
+        seq0 = str(seq0)
+        seq1 = str(seq1)
+        assert len(seq0) == len(seq1), 'CoordMapper2Seqs: sequences '\
+            'must be same length.'
         self.mapArrays = [array.array('I'), array.array('I')]
-        baseCount0 = 0  # Number of real bases in seq0 up to and including cur pos
-        baseCount1 = 0  # Number of real bases in seq1 up to and including cur pos
-        beforeStart = True # Haven't yet reached first pair of aligned real bases
-        gapSinceLast = False # Have encounted a gap since last pair in mapArrays
-        prevRealBase0 = prevRealBase1 = True
-        for b0, b1 in zip_longest(seq0, seq1) :
-            assert b0 != None and b1 != None, 'CoordMapper2Seqs: sequences '\
-                'must be same length.'
-            realBase0 = b0 != '-'
-            realBase1 = b1 != '-'
-            assert realBase0 or realBase1, 'CoordMapper2Seqs: gap aligned to gap.'
-            assert (realBase0 or prevRealBase1) and (realBase1 or prevRealBase0),\
-                 'CoordMapper2Seqs: gap in one sequence adjacent to gap in other.'
-            prevRealBase0 = realBase0
-            prevRealBase1 = realBase1
-            baseCount0 += realBase0
-            baseCount1 += realBase1
-            if realBase0 and realBase1 :
-                if beforeStart or gapSinceLast :
-                    self.mapArrays[0].append(baseCount0)
-                    self.mapArrays[1].append(baseCount1)
-                    gapSinceLast = False
-                    beforeStart = False
-                finalPos0 = baseCount0 # Last pair of aligned real bases so far
-                finalPos1 = baseCount1 # Last pair of aligned real bases so far
-            else :
-                gapSinceLast = True
+        # Rather than walking the alignment base by base, find the runs of
+        # gaps in each sequence (a C-level scan) and do Python-level work
+        # only once per indel. Columns between gap runs are aligned real bases.
+        gapRuns = sorted([m.span() + (0,) for m in GAP_RUN_RE.finditer(seq0)] +
+                         [m.span() + (1,) for m in GAP_RUN_RE.finditer(seq1)])
+        gapCount = [0, 0] # Number of gaps in each seq before current column
+        col = 0 # First column after the previous gap run
+        for start, end, which in gapRuns :
+            assert start >= col, 'CoordMapper2Seqs: gap aligned to gap.'
+            assert start > col or col == 0,\
+                'CoordMapper2Seqs: gap in one sequence adjacent to gap in other.'
+            if start > col :
+                # First pair of aligned real bases or pair following a gap
+                self.mapArrays[0].append(col + 1 - gapCount[0])
+                self.mapArrays[1].append(col + 1 - gapCount[1])
+                # Last pair of aligned real bases so far
+                finalPos0 = start - gapCount[0]
+                finalPos1 = start - gapCount[1]
+            gapCount[which] += end - start
+            col = end
+        if col < len(seq0) :
+            self.mapArrays[0].append(col + 1 - gapCount[0])
+            self.mapArrays[1].append(col + 1 - gapCount[1])
+            finalPos0 = len(seq0) - gapCount[0]
+            finalPos1 = len(seq1) - gapCount[1]
         assert len(self.mapArrays[0]) != 0, 'CoordMapper2Seqs: no aligned bases.'
         if self.mapArrays[0][-1] != finalPos0 :
             self.mapArrays[0].append(finalPos0)
@@ -181,19 +192,59 @@ class CoordMapper2Seqs(object) :
         elif fromPos == fromArray[-1] :
             result = toArray[-1]
         else :
-            insertInd = bisect.bisect(fromArray, fromPos)
-            prevFromPos = fromArray[insertInd - 1]
-            nextFromPos = fromArray[insertInd]
-            prevToPos = toArray[insertInd - 1]
-            nextToPos = toArray[insertInd]
-            assert(prevFromPos <= fromPos < nextFromPos)
-            prevPlusOffset = prevToPos + (fromPos - prevFromPos)
-            if fromPos == nextFromPos - 1 and prevPlusOffset < nextToPos - 1 :
-                result = [prevPlusOffset, nextToPos - 1]
-            else :
-                result = min(prevPlusOffset, nextToPos - 1)
+            # fromArray[0] <= fromPos < fromArray[-1], so the search can skip
+            # both endpoints
+            insertInd = bisect.bisect_right(fromArray, fromPos,
+                                            1, len(fromArray) - 1)
+            result = self._mapInterior(fromArray, toArray, fromPos, insertInd)
         return result
 
+    def map_many(self, fromPositions, fromWhich) :
+        """ Map many 1-based coordinates at once. Returns a list containing
+                what __call__ would have returned for each position.
+            fromWhich: if 0, map from 1st sequence to 2nd, o.w. 2nd to 1st.
+            Positions in increasing order (e.g., from a VCF) are mapped in
+                one sweep through mapArrays; a binary search is only needed
+                when a position is outside the current pair of entries.
+        """
+        fromArray = self.mapArrays[fromWhich]
+        toArray = self.mapArrays[1 - fromWhich]
+        firstFromPos = fromArray[0]
+        lastFromPos = fromArray[-1]
+        lastToPos = toArray[-1]
+        insertInd = 1
+        results = []
+        for fromPos in fromPositions :
+            if fromPos != int(fromPos) :
+                raise TypeError('CoordMapper2Seqs: pos %s is not an integer' % fromPos)
+            if fromPos < firstFromPos or fromPos > lastFromPos :
+                results.append(None)
+            elif fromPos == lastFromPos :
+                results.append(lastToPos)
+            else :
+                if not (fromArray[insertInd - 1] <= fromPos < fromArray[insertInd]) :
+                    insertInd = bisect.bisect_right(fromArray, fromPos,
+                                                    1, len(fromArray) - 1)
+                results.append(
+                    self._mapInterior(fromArray, toArray, fromPos, insertInd))
+        return results
+
+    @staticmethod
+    def _mapInterior(fromArray, toArray, fromPos, insertInd) :
+        """ Map a position that lies between fromArray[insertInd - 1]
+            (inclusive) and fromArray[insertInd] (exclusive).
+        """
+        prevFromPos = fromArray[insertInd - 1]
+        nextFromPos = fromArray[insertInd]
+        prevToPos = toArray[insertInd - 1]
+        nextToPos = toArray[insertInd]
+        assert(prevFromPos <= fromPos < nextFromPos)
+        prevPlusOffset = prevToPos + (fromPos - prevFromPos)
+        if fromPos == nextFromPos - 1 and prevPlusOffset < nextToPos - 1 :
+            return [prevPlusOffset, nextToPos - 1]
+        else :
+            return min(prevPlusOffset, nextToPos - 1)
+
 
 # ========== snpEff annotation of VCF files ==================
 
@@ -310,13 +361,20 @@ def multichr_mafft(args):
     # reorder the data into new FASTA files, where each FASTA file has only variants of its respective chromosome
     transposedFiles = transposeChromosomeFiles(args.inFastas)
 
-    # since the FASTA files are
-    for idx, filePath in enumerate(transposedFiles):
-        
+    # the per-chromosome alignments are independent, so run several MAFFT
+    # processes at once and split the thread budget among them
+    totalThreads = multiprocessing.cpu_count() if args.threads == -1 else args.threads
+    nWorkers = max(1, min(len(transposedFiles), totalThreads))
+    threadsPerWorker = max(1, totalThreads // nWorkers)
+    mafft = tools.mafft.MafftTool()
+    mafft.install_and_get_path()
+
+    def align_one(idxAndFilePath):
+        idx, filePath = idxAndFilePath
         # execute MAFFT alignment. The input file is passed within a list, since argparse ordinarily
         # passes input files in this way, and the MAFFT tool expects lists,
         # but in this case we are creating the input file ourselves
-        tools.mafft.MafftTool().execute(
+        mafft.execute(
                     inFastas          = [os.path.abspath(filePath)],
                     outFile           = os.path.join(absoluteOutDirectory, "{}_{}.fasta".format(prefix, idx)), 
                     localpair         = args.localpair, 
@@ -328,8 +386,9 @@ def multichr_mafft(args):
                     verbose           = args.verbose, 
                     outputAsClustal   = args.outputAsClustal, 
                     maxiters          = args.maxiters, 
-                    threads           = args.threads
+                    threads           = threadsPerWorker
         )
+    util.misc.parallel_map(align_one, enumerate(transposedFiles), threads=nWorkers)
 
     return 0
 __commands__.append(('multichr_mafft', parser_multichr_mafft))
@@ -342,11 +401,18 @@ def call_snps_3(inFasta, outVcf, REF="KJ660346.2"):
     ref_idx = find_ref(a, REF)
     with open(outVcf, 'wt') as outf:
         outf.write(vcf_header(a))
+        # write rows out in batches rather than one small write per row
+        lines = []
         for row in make_vcf(a, ref_idx, REF):
-            outf.write('\t'.join(map(str, row))+'\n')
+            lines.append('\t'.join(map(str, row)))
+            if len(lines) >= 1024:
+                outf.write('\n'.join(lines)+'\n')
+                del lines[:]
+        if lines:
+            outf.write('\n'.join(lines)+'\n')
 def find_ref(a, ref):
-    for i in range(len(a)):
-        if a[i].id == ref:
+    for i, rec in enumerate(a):
+        if rec.id == ref:
             return i
     return -1
 def vcf_header(a):
@@ -357,26 +423,28 @@ def vcf_header(a):
     return header
 def make_vcf(a, ref_idx, chrom):
     bases=set(["A", "C", "G", "T"])
-    for i in range(len(a[0])):
+    # Transpose the alignment into columns of single-base strings once,
+    # rather than indexing through each SeqRecord for every base.
+    seqs = [str(rec.seq) for rec in a]
+    for i, col in enumerate(zip(*seqs)):
+        refBase = col[ref_idx]
+        if refBase not in bases or len(set(col)) == 1:
+            # nothing to call against an ambiguous/gap ref base, nor in an
+            # invariant column
+            continue
         alt = []
-        for j in range(len(a)):
-            if (a[j][i] != a[ref_idx][i]) and ((a[ref_idx][i] in bases) and (a[j][i] in bases)) and a[j][i] not in alt:
-                alt.append(a[j][i])
-        if len(alt) > 0:
-            row = [chrom, i+1, '.', a[ref_idx][i], ','.join(alt), '.', '.', '.', 'GT']
-            genos = []
-            for k in range(len(a)):
-                if a[k][i] == a[ref_idx][i]:
-                    genos.append(0)
-                elif a[k][i] not in bases:
-                    genos.append(".")
-                else:
-                    for m in range(0, len(alt)):
-                        if a[k][i] == alt[m]:
-                            genos.append(m+1)
+        altIndex = {} # {base : allele number in the GT field}
+        for base in col:
+            if base != refBase and base in bases and base not in altIndex:
+                alt.append(base)
+                altIndex[base] = len(alt)
+        if alt:
+            row = [chrom, i+1, '.', refBase, ','.join(alt), '.', '.', '.', 'GT']
+            altIndex[refBase] = 0
+            genos = [altIndex.get(base, ".") for base in col]
             yield row+genos
 
-def transposeChromosomeFiles(inputFilenamesList):
+def transposeChromosomeFiles(inputFilenamesList, outputDir=None):
     ''' Input:  a list of FASTA files representing a genome for each sample.
                 Each file contains the same number of sequences (chromosomes, segments,
                 etc) in the same order.
@@ -384,25 +452,32 @@ def transposeChromosomeFiles(inputFilenamesList):
                 chromosome/segment for input to a multiple sequence aligner.
                 The number of FASTA files corresponds to the number of chromosomes
                 in the genome.  Each file contains the same number of samples
-                in the same order.  Each output file is a tempfile.
+                in the same order.  Each output file is a tempfile, unless
+                outputDir is specified, in which case the files are named
+                chr1.fasta, chr2.fasta, etc within outputDir.
     '''
     outputFilenames = []
 
     # open all files
-    inputFilesList = [util.file.open_or_gzopen(x, 'rU') for x in inputFilenamesList]
-    # get BioPython iterators for each of the FASTA files specified in the input
-    fastaFiles = [SeqIO.parse(x, 'fasta') for x in inputFilesList]
+    inputFilesList = [util.file.open_or_gzopen(x, 'rt') for x in inputFilenamesList]
+    # get raw record iterators for each of the FASTA files specified in the input
+    fastaFiles = [_iter_fasta_raw(x) for x in inputFilesList]
 
     # for each interleaved record
     for chrRecordList in zip_longest(*fastaFiles):
         if any(rec==None for rec in chrRecordList):
             raise Exception("input files must all have the same number of sequences")
         
-        outputFilename = util.file.mkstempfname('.fasta')
+        if outputDir:
+            outputFilename = os.path.join(outputDir,
+                'chr{}.fasta'.format(len(outputFilenames) + 1))
+        else:
+            outputFilename = util.file.mkstempfname('.fasta')
         outputFilenames.append(outputFilename)
-        with open(outputFilename, "w") as outf:
+        with open(outputFilename, "wt") as outf:
             # write the corresonding records to a new FASTA file
-            SeqIO.write(chrRecordList, outf, 'fasta')
+            for rec in chrRecordList:
+                outf.writelines(rec)
 
     # close all input files
     for x in inputFilesList:
@@ -410,6 +485,27 @@ def transposeChromosomeFiles(inputFilenamesList):
 
     return outputFilenames
 
+def _iter_fasta_raw(inf):
+    ''' Iterate over the records of an open FASTA file without parsing them.
+        Each record is yielded as a list of its lines (header first), each
+        ending in a newline, so that records can be copied to another file
+        without constructing SeqRecord objects.
+    '''
+    rec = None
+    for line in inf:
+        if not line.strip():
+            continue
+        if not line.endswith('\n'):
+            line += '\n'
+        if line.startswith('>'):
+            if rec:
+                yield rec
+            rec = [line]
+        elif rec is not None:
+            rec.append(line)
+    if rec:
+        yield rec
+
 def full_parser():
     return util.cmd.make_parser(__commands__, __doc__)
 if __name__ == '__main__':
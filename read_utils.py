@@ -8,9 +8,12 @@ from __future__ import division
 __author__ = "irwin@broadinstitute.org, dpark@broadinstitute.org"
 __commands__ = []
 
-import argparse, logging, math, os, tempfile, shutil, subprocess
-from Bio import SeqIO
-import util.cmd, util.file
+import argparse, logging, math, os, tempfile, shutil, subprocess, itertools
+import multiprocessing
+import pysam
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+import util.cmd, util.file, util.misc
 from util.file import mkstempfname
 import tools.picard, tools.samtools, tools.mvicuna, tools.prinseq
 import tools.novoalign, tools.gatk
@@ -61,16 +64,16 @@ __commands__.append(('purge_unmated', parser_purge_unmated))
 # =========================
 def fastq_to_fasta(inFastq, outFasta) :
     'Convert from fastq format to fasta format.'
-    'Warning: output reads might be split onto multiple lines.'
+    'Output reads are written one sequence per line.'
     
     # Do this with biopython rather than prinseq, because if the latter fails
-    #    it doesn't return an error. (On the other hand, prinseq
-    #    can guarantee that output lines are not split...)
-    inFile  = util.file.open_or_gzopen(inFastq)
-    outFile = util.file.open_or_gzopen(outFasta, 'w')
-    for rec in SeqIO.parse(inFile, 'fastq') :
-        SeqIO.write([rec], outFile, 'fasta')
-    outFile.close()
+    #    it doesn't return an error. FastqGeneralIterator still validates
+    #    the input but yields plain strings, so there is no per-read
+    #    SeqRecord to build and reformat.
+    with util.file.open_or_gzopen(inFastq, 'rt') as inFile:
+        with util.file.open_or_gzopen(outFasta, 'wt') as outFile:
+            for title, seq, qual in FastqGeneralIterator(inFile) :
+                outFile.write('>' + title + '\n' + seq + '\n')
     return 0
 def parser_fastq_to_fasta(parser=argparse.ArgumentParser()):
     parser.add_argument('inFastq', help='Input fastq file.')
@@ -238,11 +241,25 @@ def parser_merge_bams(parser=argparse.ArgumentParser()):
         help='JVM virtual memory size (default: %(default)s)')
     parser.add_argument('--picardOptions', default = [], nargs='*',
         help='Optional arguments to Picard\'s MergeSamFiles, OPTIONNAME=value ...')
+    parser.add_argument("--samtools",
+        help="""Merge with samtools (multithreaded) instead of Picard. Input
+            files must already be coordinate sorted and share a sequence
+            dictionary. The output header is the first input's, plus the
+            @RG lines of all inputs. Unlike Picard, this does not re-sort,
+            so it cannot be combined with picardOptions (such as
+            SORT_ORDER=queryname); JVMmemory is ignored.""",
+        default=False, action="store_true", dest="samtools")
     util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmpDir', None)))
     util.cmd.attach_main(parser, main_merge_bams)
     return parser
 def main_merge_bams(args) :
     '''Merge multiple BAMs into one'''
+    if args.samtools:
+        if args.picardOptions:
+            raise Exception('--picardOptions cannot be used with --samtools')
+        tools.samtools.SamtoolsTool().merge(args.inBams, args.outBam,
+            threads=multiprocessing.cpu_count())
+        return 0
     opts = list(args.picardOptions) + ['USE_THREADING=true']
     tools.picard.MergeSamFilesTool().execute(
         args.inBams, args.outBam,
@@ -370,6 +387,29 @@ defaultIndexLen = 2
 defaultMaxReads = 1000
 defaultFormat = 'fastq'
 
+def count_reads(inFileName, format = defaultFormat) :
+    '''Count the reads in a fasta or fastq file (optionally gzipped) by
+       scanning raw bytes rather than parsing records. Fastq records are
+       assumed to be four lines each.
+    '''
+    count = 0
+    lastByte = b'\n'
+    with util.file.open_or_gzopen(inFileName, 'rb') as inFile :
+        for buf in iter(lambda: inFile.read(1 << 20), b'') :
+            if format == 'fastq' :
+                count += buf.count(b'\n')
+            else :
+                # a record starts at each '>' at the beginning of a line
+                count += buf.count(b'\n>')
+                if lastByte == b'\n' and buf.startswith(b'>') :
+                    count += 1
+            lastByte = buf[-1:]
+    if format == 'fastq' :
+        if lastByte != b'\n' :
+            count += 1 # final line has no newline
+        count //= 4
+    return count
+
 def split_reads(inFileName, outPrefix, outSuffix = "",
                 maxReads = None, numChunks = None,
                 indexLen = defaultIndexLen, format = defaultFormat) :
@@ -379,26 +419,41 @@ def split_reads(inFileName, outPrefix, outSuffix = "",
        The number of characters in file names after outPrefix is indexLen;
             if not specified, use defaultIndexLen.
     '''
+    plainFileName = None
     if maxReads == None :
         if numChunks == None :
             maxReads = defaultMaxReads
         else :
-            with util.file.open_or_gzopen(inFileName, 'rt') as inFile :
-                totalReadCount = 0
-                for rec in SeqIO.parse(inFile, format) :
-                    totalReadCount += 1
-                maxReads = int(totalReadCount / numChunks + 0.5)
+            if inFileName.endswith('.gz') :
+                # Decompress once up front, rather than once to count the
+                # reads and again to split them.
+                plainFileName = mkstempfname('.' + format)
+                with util.file.open_or_gzopen(inFileName, 'rb') as inf :
+                    with open(plainFileName, 'wb') as outf :
+                        shutil.copyfileobj(inf, outf, 1 << 20)
+                inFileName = plainFileName
+            totalReadCount = count_reads(inFileName, format)
+            maxReads = int(totalReadCount / numChunks + 0.5)
+
+    # Parse into plain string tuples rather than SeqRecords, and write them
+    # back out with a fixed template.
+    if format == 'fastq' :
+        recordParser = FastqGeneralIterator
+        recordTemplate = "@{}\n{}\n+\n{}\n"
+    else :
+        recordParser = SimpleFastaParser
+        recordTemplate = ">{}\n{}\n"
+    indexstring = "%0" + str(indexLen) + "d"
 
     with util.file.open_or_gzopen(inFileName, 'rt') as inFile :
         readsWritten = 0
         curIndex = 0
         outFile = None
-        for rec in SeqIO.parse(inFile, format) :
+        for rec in recordParser(inFile) :
             if outFile == None :
-                indexstring = "%0" + str(indexLen) + "d"
                 outFileName = outPrefix + (indexstring % (curIndex+1)) + outSuffix
                 outFile = util.file.open_or_gzopen(outFileName, 'wt')
-            SeqIO.write([rec], outFile, format)
+            outFile.write(recordTemplate.format(*rec))
             readsWritten += 1
             if readsWritten == maxReads :
                 outFile.close()
@@ -407,7 +462,9 @@ def split_reads(inFileName, outPrefix, outSuffix = "",
                 curIndex += 1
         if outFile != None :
             outFile.close()
-    
+
+    if plainFileName :
+        os.unlink(plainFileName)
     return 0
 
 def parser_split_reads(parser=argparse.ArgumentParser()):
@@ -440,7 +497,6 @@ __commands__.append(('split_reads', parser_split_reads))
 def split_bam(inBam, outBams) :
     '''Split BAM file equally into several output BAM files. '''
     samtools = tools.samtools.SamtoolsTool()
-    picard = tools.picard.PicardTools()
     
     # get totalReadCount and maxReads
     # maxReads = totalReadCount / num files, but round up to the nearest
@@ -452,36 +508,22 @@ def split_bam(inBam, outBams) :
     log.info("splitting %d reads into %d files of %d reads each",
         totalReadCount, len(outBams), maxReads)
     
-    # load BAM header into memory
+    # check the BAM header
     header = samtools.getHeader(inBam)
     if 'SO:queryname' not in header[0]:
         raise Exception('Input BAM file must be sorted in queryame order')
     
-    # dump to bigsam
-    bigsam = mkstempfname('.sam')
-    samtools.view([], inBam, bigsam)
-    
-    # split bigsam into little ones
-    with util.file.open_or_gzopen(bigsam, 'rt') as inf:
-        for outBam in outBams:
-            log.info("preparing file "+outBam)
-            tmp_sam_reads = mkstempfname('.sam')
-            with open(tmp_sam_reads, 'wt') as outf:
-                for row in header:
-                    outf.write('\t'.join(row)+'\n')
-                for i in range(maxReads):
-                    line = inf.readline()
-                    if not line:
-                        break
-                    outf.write(line)
-                if outBam == outBams[-1]:
-                    for line in inf:
-                        outf.write(line)
-            picard.execute("SamFormatConverter", [
-                'INPUT='+tmp_sam_reads, 'OUTPUT='+outBam,
-                'VERBOSITY=WARNING'], JVMmemory='512m')
-            os.unlink(tmp_sam_reads)
-    os.unlink(bigsam)
+    # Stream reads straight from the input BAM into each output BAM, rather
+    # than round-tripping through SAM text and a Picard JVM per output file.
+    inb = pysam.AlignmentFile(inBam, 'rb', check_sq=False)
+    for outBam in outBams:
+        log.info("preparing file "+outBam)
+        if outBam == outBams[-1]:
+            reads = inb
+        else:
+            reads = itertools.islice(inb, maxReads)
+        _write_bam(inBam, inb, reads, outBam)
+    inb.close()
 def parser_split_bam(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam', help='Input BAM file.')
     parser.add_argument('outBams', nargs='+', help='Output BAM files')
@@ -501,20 +543,48 @@ def mvicuna_fastqs_to_readlist(inFastq1, inFastq2, readList):
     outFastq2 = mkstempfname('.2.fastq')
     tools.mvicuna.MvicunaTool().rmdup((inFastq1, inFastq2), (outFastq1, outFastq2), None)
     
-    # Make a list of reads to keep
-    with open(readList, 'at') as outf:
+    # Make a list of reads to keep. Only the header line of each fastq
+    # record is needed, so pick out every fourth line with islice and
+    # handle them as raw bytes rather than decoding the whole file.
+    with open(readList, 'ab', 1 << 20) as outf:
         for fq in (outFastq1, outFastq2):
-            with util.file.open_or_gzopen(fq, 'rt') as inf:
-                line_num = 0
-                for line in inf:
-                    if (line_num % 4) == 0:
-                        id = line.rstrip('\n')[1:]
-                        if id.endswith('/1'):
-                            outf.write(id[:-2]+'\n')
-                    line_num += 1
+            with util.file.open_or_gzopen(fq, 'rb') as inf:
+                ids = (line.rstrip(b'\n')[1:]
+                    for line in itertools.islice(inf, 0, None, 4))
+                outf.writelines(id[:-2]+b'\n' for id in ids if id.endswith(b'/1'))
     os.unlink(outFastq1)
     os.unlink(outFastq2)
 
+def _write_bam(inBam, inb, reads, outBam):
+    ''' Write reads (from inb, the open inBam) to outBam with inBam's
+        header. Returns the number of reads written.
+    '''
+    outb = None
+    n = 0
+    for read in reads:
+        if outb is None:
+            outb = pysam.AlignmentFile(outBam, 'wb', template=inb)
+        outb.write(read)
+        n += 1
+    if outb is None:
+        # pysam.AlignmentFile cannot write an empty file, but
+        # FilterSamReadsTool handles an empty include-list this way
+        emptyList = mkstempfname('.txt')
+        tools.picard.FilterSamReadsTool().execute(inBam, False, emptyList, outBam)
+        os.unlink(emptyList)
+    else:
+        outb.close()
+    return n
+
+def filter_bam_reads(inBam, outBam, keepReads):
+    ''' Write the reads of inBam whose names are in keepReads to outBam,
+        in their original order. '''
+    inb = pysam.AlignmentFile(inBam, 'rb', check_sq=False)
+    n = _write_bam(inBam, inb,
+        (read for read in inb if read.query_name in keepReads), outBam)
+    inb.close()
+    return n
+
 def rmdup_mvicuna_bam(inBam, outBam, JVMmemory=None):
     ''' Remove duplicate reads from BAM file using M-Vicuna. The
         primary advantage to this approach over Picard's MarkDuplicates tool
@@ -525,7 +595,7 @@ def rmdup_mvicuna_bam(inBam, outBam, JVMmemory=None):
     # Convert BAM -> FASTQ pairs per read group and load all read groups
     tempDir = tempfile.mkdtemp()
     tools.picard.SamToFastqTool().per_read_group(inBam, tempDir,
-        picardOptions=['VALIDATION_STRINGENCY=LENIENT'])
+        picardOptions=['VALIDATION_STRINGENCY=LENIENT'], JVMmemory=JVMmemory)
     read_groups = [x[1:] for x in
         tools.samtools.SamtoolsTool().getHeader(inBam)
         if x[0]=='@RG']
@@ -541,38 +611,49 @@ def rmdup_mvicuna_bam(inBam, outBam, JVMmemory=None):
         lb_to_files[rg.get('LB','none')].add(os.path.join(tempDir, fname))
     log.info("found %d distinct libraries and %d read groups", len(lb_to_files), len(read_groups))
     
-    # For each library, merge FASTQs and run rmdup for entire library
-    readList = mkstempfname('.keep_reads.txt')
-    for lb, files in lb_to_files.items():
+    # For each library, merge FASTQs and run rmdup for entire library.
+    # Libraries are independent, so run several M-Vicuna processes at once.
+    def dedup_library(lb_and_files):
+        lb, files = lb_and_files
         log.info("executing M-Vicuna DupRm on library " + lb)
         
         # create merged FASTQs per library
         infastqs = (mkstempfname('.1.fastq'), mkstempfname('.2.fastq'))
         for d in range(2):
-            with open(infastqs[d], 'wt') as outf:
+            with open(infastqs[d], 'wb') as outf:
                 for fprefix in files:
                     fn = '%s_%d.fastq' % (fprefix, d+1)
                     if os.path.isfile(fn):
-                        with open(fn, 'rt') as inf:
-                            for line in inf:
-                                outf.write(line)
+                        with open(fn, 'rb') as inf:
+                            shutil.copyfileobj(inf, outf, 1024*1024)
                         os.unlink(fn)
                     else:
                         log.warn("no reads found in %s, assuming that's because there's no reads in that read group", fn)
         
-        # M-Vicuna DupRm to see what we should keep (append IDs to running file)
-        mvicuna_fastqs_to_readlist(infastqs[0], infastqs[1], readList)
+        # M-Vicuna DupRm to see what we should keep
+        lbReadList = mkstempfname('.keep_reads.txt')
+        mvicuna_fastqs_to_readlist(infastqs[0], infastqs[1], lbReadList)
         for fn in infastqs:
             os.unlink(fn)
+        return lbReadList
+    lbReadLists = util.misc.parallel_map(dedup_library, lb_to_files.items(),
+        threads=max(1, multiprocessing.cpu_count()//2))
+    
+    # Load the per-library keep-lists
+    keepReads = set()
+    for lbReadList in lbReadLists:
+        with open(lbReadList, 'rt') as inf:
+            keepReads.update(line.rstrip('\n') for line in inf)
+        os.unlink(lbReadList)
     
-    # Filter original input BAM against keep-list
-    tools.picard.FilterSamReadsTool().execute(inBam, False, readList, outBam, JVMmemory=JVMmemory)
+    # Filter original input BAM against keep-list in a single pass
+    filter_bam_reads(inBam, outBam, keepReads)
     return 0
 
 def parser_rmdup_mvicuna_bam(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam', help='Input reads, BAM format.')
     parser.add_argument('outBam', help='Output reads, BAM format.')
-    parser.add_argument('--JVMmemory', default = tools.picard.FilterSamReadsTool.jvmMemDefault,
+    parser.add_argument('--JVMmemory', default = tools.picard.SamToFastqTool.jvmMemDefault,
         help='JVM virtual memory size (default: %(default)s)')
     util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmpDir', None)))
     util.cmd.attach_main(parser, rmdup_mvicuna_bam, split_args=True)
@@ -626,6 +707,21 @@ def rmdup_prinseq_fastq(inFastq, outFastq):
             ]
         log.debug(' '.join(cmd))
         subprocess.check_call(cmd)
+def rmdup_exact_fastq(inFastq, outFastq):
+    ''' Pure python approximation of the prinseq-lite call in
+        rmdup_prinseq_fastq: drop reads with more than one N and all but the
+        first copy of any exact duplicate sequence, in a single pass over the
+        input. Output is not guaranteed to be identical to prinseq's.
+    '''
+    seen = set()
+    with util.file.open_or_gzopen(inFastq, 'rt') as inf:
+        with util.file.open_or_gzopen(outFastq, 'wt') as outf:
+            for title, seq, qual in FastqGeneralIterator(inf):
+                if seq.count('N') + seq.count('n') > 1 or seq in seen:
+                    continue
+                seen.add(seq)
+                outf.write('@'+title+'\n'+seq+'\n+\n'+qual+'\n')
+
 def parser_rmdup_prinseq_fastq(parser=argparse.ArgumentParser()):
     parser.add_argument('inFastq1',
         help='Input fastq file; 1st end of paired-end reads.')
@@ -635,6 +731,11 @@ def parser_rmdup_prinseq_fastq(parser=argparse.ArgumentParser()):
         help='Output fastq file; 1st end of paired-end reads.')
     parser.add_argument('outFastq2',
         help='Output fastq file; 2nd end of paired-end reads.')
+    parser.add_argument("--fastRmdup",
+        help="""Do the duplicate and N filtering in python instead of calling
+            prinseq-lite. Much faster, but output is not guaranteed to be
+            identical to prinseq's.""",
+        default=False, action="store_true", dest="fastRmdup")
     util.cmd.common_args(parser, (('loglevel', None), ('version', None), ('tmpDir', None)))
     util.cmd.attach_main(parser, main_rmdup_prinseq_fastq)
     return parser
@@ -642,8 +743,16 @@ def main_rmdup_prinseq_fastq(args):
     ''' Run prinseq-lite's duplicate removal operation on paired-end 
         reads.  Also removes reads with more than one N.
     '''
-    rmdup_prinseq_fastq(args.inFastq1, args.outFastq1)
-    rmdup_prinseq_fastq(args.inFastq2, args.outFastq2)
+    if args.fastRmdup:
+        # pure python and CPU bound, so threads would not help here
+        rmdup_exact_fastq(args.inFastq1, args.outFastq1)
+        rmdup_exact_fastq(args.inFastq2, args.outFastq2)
+        return 0
+    # the two mates are independent prinseq-lite runs, so do them at once
+    tools.prinseq.PrinseqTool().install_and_get_path()
+    util.misc.parallel_map(lambda p: rmdup_prinseq_fastq(*p),
+        [(args.inFastq1, args.outFastq1), (args.inFastq2, args.outFastq2)],
+        threads=2)
     return 0
 __commands__.append(('rmdup_prinseq_fastq', parser_rmdup_prinseq_fastq))
 
@@ -653,9 +762,11 @@ def filter_bam_mapped_only(inBam, outBam):
         aligned (-F 4) with a non-zero mapping quality (-q 1)
         and are not marked as a PCR/optical duplicate (-F 1024).
     '''
-    tools.samtools.SamtoolsTool().view(
-        ['-b', '-q', '1', '-F', '1028'], inBam, outBam)
-    tools.picard.BuildBamIndexTool().execute(outBam)
+    samtools = tools.samtools.SamtoolsTool()
+    samtools.view(
+        ['-b', '-q', '1', '-F', '1028'], inBam, outBam,
+        threads=min(4, multiprocessing.cpu_count()))
+    samtools.index(outBam, os.path.splitext(outBam)[0] + '.bai')
     return 0
 def parser_filter_bam_mapped_only(parser=argparse.ArgumentParser()):
     parser.add_argument('inBam',
@@ -758,7 +869,8 @@ def align_and_fix(inBam, refFasta, outBamAll=None, outBamFiltered=None,
     bam_aligned = mkstempfname('.aligned.bam')
     tools.novoalign.NovoalignTool().execute(
         inBam, refFasta, bam_aligned,
-        options=novoalign_options.split(), JVMmemory=JVMmemory)
+        options=novoalign_options.split(), JVMmemory=JVMmemory,
+        create_index=False)
     
     bam_mkdup = mkstempfname('.mkdup.bam')
     tools.picard.MarkDuplicatesTool().execute(
@@ -766,20 +878,31 @@ def align_and_fix(inBam, refFasta, outBamAll=None, outBamFiltered=None,
         picardOptions=['CREATE_INDEX=true'], JVMmemory=JVMmemory)
     os.unlink(bam_aligned)
     
-    bam_realigned = mkstempfname('.realigned.bam')
+    # IndelRealigner needs an indexed input and makes two passes over it, as
+    # does MarkDuplicates, so these stages cannot be streamed. We can at least
+    # write the final stage straight into outBamAll rather than a tempfile.
+    if outBamAll:
+        bam_realigned = outBamAll
+    else:
+        bam_realigned = mkstempfname('.realigned.bam')
     tools.gatk.GATKTool().local_realign(
         bam_mkdup, refFasta, bam_realigned, JVMmemory=JVMmemory)
     os.unlink(bam_mkdup)
+    for fn in (bam_aligned[:-4]+'.bai', bam_mkdup[:-4]+'.bai'):
+        if os.path.isfile(fn):
+            os.unlink(fn)
     
+    samtools = tools.samtools.SamtoolsTool()
     if outBamAll:
-        shutil.copyfile(bam_realigned, outBamAll)
-        tools.picard.BuildBamIndexTool().execute(outBamAll)
+        samtools.index(outBamAll, os.path.splitext(outBamAll)[0] + '.bai')
     if outBamFiltered:
-        tools.samtools.SamtoolsTool().view(
+        samtools.view(
             ['-b', '-q', '1', '-F', '1028'],
-            bam_realigned, outBamFiltered)
-        tools.picard.BuildBamIndexTool().execute(outBamFiltered)
-    os.unlink(bam_realigned)
+            bam_realigned, outBamFiltered,
+            threads=min(4, multiprocessing.cpu_count()))
+        samtools.index(outBamFiltered, os.path.splitext(outBamFiltered)[0] + '.bai')
+    if not outBamAll:
+        os.unlink(bam_realigned)
     
 
 def parser_align_and_fix(parser=argparse.ArgumentParser()):
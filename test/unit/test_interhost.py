@@ -134,4 +134,16 @@ class TestCoordMapper2Seqs(test.TestCaseWithTmp):
         self.assertEqual([cm2s(n, 0) for n in [1, 2]], [[1, 3], 4])
         self.assertEqual([cm2s(n, 1) for n in [1, 2, 3, 4]], [1, 1, 1, 2])
 
+    def test_map_many(self) :
+        cm2s = Cm2s('ATG--CACGTACGTATGCAAATCGG', 'ATGCACACGTA--TATGCAAATCGG')
+        for fromWhich in (0, 1) :
+            positions = list(range(-1, 27))
+            self.assertEqual(cm2s.map_many(positions, fromWhich),
+                             [cm2s(n, fromWhich) for n in positions])
+            positions.reverse()
+            self.assertEqual(cm2s.map_many(positions, fromWhich),
+                             [cm2s(n, fromWhich) for n in positions])
+        with self.assertRaises(TypeError):
+            cm2s.map_many([1, 2.5], 0)
+
     
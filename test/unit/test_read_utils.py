@@ -2,7 +2,8 @@
 
 __author__ = "irwin@broadinstitute.org"
 
-import unittest, os, tempfile, argparse, filecmp
+import unittest, os, tempfile, argparse, filecmp, itertools
+import pysam
 import util, util.file, read_utils, tools, tools.samtools
 from test import TestCaseWithTmp
 
@@ -175,8 +176,27 @@ class TestSplitReads(TestCaseWithTmp) :
         expectedFasta2 = os.path.join(myInputDir, 'expected.fasta.02')
         self.assertEqualContents(outPrefix + '01', expectedFasta1)
         self.assertEqualContents(outPrefix + '02', expectedFasta2)
+
+    def test_count_reads(self) :
+        'Test counting reads in fastq and fasta files, gzipped or not.'
+        myInputDir = util.file.get_test_input_path(self)
+        for fileName, format, count in [('in.fastq', 'fastq', 5),
+                                        ('in.fastq.gz', 'fastq', 5),
+                                        ('in.fasta', 'fasta', 4),
+                                        ('in.fasta.gz', 'fasta', 4)] :
+            self.assertEqual(count, read_utils.count_reads(
+                os.path.join(myInputDir, fileName), format))
         
 
+class TestRmdupExactFastq(TestCaseWithTmp) :
+    def test_rmdup_exact_fastq(self) :
+        myInputDir = util.file.get_test_input_path(self)
+        inFastq = os.path.join(myInputDir, 'in.fastq')
+        outFastq = util.file.mkstempfname('.fastq')
+        read_utils.rmdup_exact_fastq(inFastq, outFastq)
+        self.assertEqualContents(outFastq,
+            os.path.join(myInputDir, 'expected.fastq'))
+
 class TestMvicuna(TestCaseWithTmp) :
     """
     Input consists of 3 read pairs.
@@ -212,5 +232,87 @@ class TestMvicuna(TestCaseWithTmp) :
                 os.path.join(tempDir, filename),
                 os.path.join(myInputDir, 'expected_' + filename))
 
+class TestSplitBam(TestCaseWithTmp) :
+    def setUp(self):
+        super(TestSplitBam, self).setUp()
+        self.inBam = os.path.join(util.file.get_test_input_path(),
+            'G5012.3.testreads.bam')
+
+    def read_bam(self, bam):
+        inb = pysam.AlignmentFile(bam, 'rb', check_sq=False)
+        header = dict(inb.header)
+        names = [read.query_name for read in inb]
+        inb.close()
+        return header, names
+
+    def test_split_bam(self) :
+        inHeader, inNames = self.read_bam(self.inBam)
+        outBams = [util.file.mkstempfname('.{}.bam'.format(i)) for i in range(3)]
+        read_utils.split_bam(self.inBam, outBams)
+        outNames = []
+        for outBam in outBams:
+            header, names = self.read_bam(outBam)
+            self.assertEqual(header, inHeader)
+            outNames.append(names)
+        self.assertEqual([len(names) for names in outNames], [6238, 6238, 6234])
+        # read pairs are not split across files
+        for names, nextNames in zip(outNames, outNames[1:]):
+            self.assertNotEqual(names[-1], nextNames[0])
+        self.assertEqual(list(itertools.chain(*outNames)), inNames)
+
+    def test_split_bam_more_files_than_reads(self) :
+        # a 4 read input
+        inb = pysam.AlignmentFile(self.inBam, 'rb', check_sq=False)
+        inBam = util.file.mkstempfname('.bam')
+        outb = pysam.AlignmentFile(inBam, 'wb', template=inb)
+        for read in itertools.islice(inb, 4):
+            outb.write(read)
+        outb.close()
+        inb.close()
+        inHeader, inNames = self.read_bam(inBam)
+        
+        outBams = [util.file.mkstempfname('.{}.bam'.format(i)) for i in range(3)]
+        read_utils.split_bam(inBam, outBams)
+        outNames = [self.read_bam(outBam)[1] for outBam in outBams]
+        self.assertEqual(outNames, [inNames[:2], inNames[2:], []])
+        header = self.read_bam(outBams[-1])[0]
+        self.assertEqual([rg['ID'] for rg in header['RG']],
+            [rg['ID'] for rg in inHeader['RG']])
+
+class TestFilterBamReads(TestCaseWithTmp) :
+    def setUp(self):
+        super(TestFilterBamReads, self).setUp()
+        self.inBam = os.path.join(util.file.get_test_input_path(),
+            'G5012.3.testreads.bam')
+        inb = pysam.AlignmentFile(self.inBam, 'rb', check_sq=False)
+        self.header = dict(inb.header)
+        self.names = [read.query_name for read in inb]
+        inb.close()
+
+    def read_bam(self, bam):
+        outb = pysam.AlignmentFile(bam, 'rb', check_sq=False)
+        header = dict(outb.header)
+        names = [read.query_name for read in outb]
+        outb.close()
+        return header, names
+
+    def test_filter(self) :
+        keepReads = set(self.names[::7])
+        outBam = util.file.mkstempfname('.bam')
+        n = read_utils.filter_bam_reads(self.inBam, outBam, keepReads)
+        header, names = self.read_bam(outBam)
+        self.assertEqual(header, self.header)
+        self.assertEqual(names, [x for x in self.names if x in keepReads])
+        self.assertEqual(n, len(names))
+
+    def test_filter_none_kept(self) :
+        outBam = util.file.mkstempfname('.bam')
+        n = read_utils.filter_bam_reads(self.inBam, outBam, set(['nonexistent']))
+        header, names = self.read_bam(outBam)
+        self.assertEqual(n, 0)
+        self.assertEqual(names, [])
+        self.assertEqual([rg['ID'] for rg in header['RG']],
+            [rg['ID'] for rg in self.header['RG']])
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,7 +2,7 @@
 
 __author__ = "dpark@broadinstitute.org"
 
-import unittest, os.path, shutil
+import unittest, os.path, shutil, collections
 import util.file, tools.novoalign, tools.samtools
 import pysam
 from test import TestCaseWithTmp
@@ -139,3 +139,62 @@ class TestToolNovoalign(TestCaseWithTmp) :
         self.assertTrue(os.path.getsize(outBam))
         self.assertTrue(os.path.isfile(outBam[:-1]+'i'))
         
+
+class TestSplitByReadGroup(TestCaseWithTmp) :
+    ''' These only use pysam, so they do not need Novoalign installed. '''
+
+    def setUp(self):
+        super(TestSplitByReadGroup, self).setUp()
+        self.novoalign = tools.novoalign.NovoalignTool()
+        self.inBam = os.path.join(util.file.get_test_input_path(),
+            'G5012.3.testreads.bam')
+        inb = pysam.AlignmentFile(self.inBam, 'rb', check_sq=False)
+        self.inRgs = [rg['ID'] for rg in dict(inb.header)['RG']]
+        self.inCounts = collections.Counter(read.opt('RG') for read in inb)
+        inb.close()
+
+    def test_split_counts(self) :
+        outBams = self.novoalign._split_bam_by_rg(self.inBam)
+        self.assertEqual(len(self.inRgs), 12)
+        counts = {}
+        for rgid, bam in outBams:
+            outb = pysam.AlignmentFile(bam, 'rb', check_sq=False)
+            counts[rgid] = sum(1 for read in outb)
+            outb.close()
+        self.assertEqual(counts, dict(self.inCounts))
+        self.assertEqual(sum(counts.values()), sum(self.inCounts.values()))
+
+    def test_split_headers(self) :
+        for rgid, bam in self.novoalign._split_bam_by_rg(self.inBam):
+            outb = pysam.AlignmentFile(bam, 'rb', check_sq=False)
+            self.assertEqual([rg['ID'] for rg in dict(outb.header)['RG']], [rgid])
+            self.assertTrue(all(read.opt('RG') == rgid for read in outb))
+            outb.close()
+
+    def test_split_drops_empty(self) :
+        outBams = self.novoalign._split_bam_by_rg(self.inBam)
+        empty = [rgid for rgid in self.inRgs if rgid not in self.inCounts]
+        self.assertEqual(len(empty), 4)
+        self.assertEqual(len(outBams), 8)
+        for rgid in empty:
+            self.assertNotIn(rgid, [r for r, bam in outBams])
+
+    def test_split_selected(self) :
+        empty = [rgid for rgid in self.inRgs if rgid not in self.inCounts]
+        outBams = self.novoalign._split_bam_by_rg(self.inBam,
+            rgids=['HBDJL.1', empty[0]])
+        self.assertEqual([r for r, bam in outBams], ['HBDJL.1'])
+
+    def test_split_in_batches(self) :
+        maxOpen = tools.novoalign.MAX_OPEN_BAMS
+        tools.novoalign.MAX_OPEN_BAMS = 5
+        try:
+            outBams = self.novoalign._split_bam_by_rg(self.inBam)
+        finally:
+            tools.novoalign.MAX_OPEN_BAMS = maxOpen
+        counts = {}
+        for rgid, bam in outBams:
+            outb = pysam.AlignmentFile(bam, 'rb', check_sq=False)
+            counts[rgid] = sum(1 for read in outb)
+            outb.close()
+        self.assertEqual(counts, dict(self.inCounts))
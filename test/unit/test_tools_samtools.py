@@ -3,6 +3,7 @@
 __author__ = "dpark@broadinstitute.org"
 
 import unittest, os, tempfile, shutil
+import pysam
 import util, util.file, tools, tools.samtools
 from test import TestCaseWithTmp
 
@@ -24,5 +25,33 @@ class TestToolSamtools(TestCaseWithTmp):
             samtools.faidx(inRef)
             self.assertEqualContents(outFai, expected_fai)
 
+    def test_merged_header(self):
+        inBam = os.path.join(util.file.get_test_input_path(), 'G5012.3.testreads.bam')
+        inb = pysam.AlignmentFile(inBam, 'rb', check_sq=False)
+        header = dict(inb.header)
+        inb.close()
+        rgids = [rg['ID'] for rg in header['RG']]
+        
+        # two header-only BAMs, each with half of the read groups
+        bams = []
+        for rgs in (header['RG'][:6], header['RG'][6:]):
+            bamHeader = dict(header)
+            bamHeader['RG'] = rgs
+            bamHeader['HD'] = dict(header['HD'], SO='unsorted')
+            bam = util.file.mkstempfname('.bam')
+            pysam.AlignmentFile(bam, 'wb', header=bamHeader).close()
+            bams.append(bam)
+        
+        outHeader = util.file.mkstempfname('.header.sam')
+        tools.samtools.merged_header(bams, outHeader)
+        merged = dict(pysam.AlignmentFile(outHeader, 'r', check_sq=False).header)
+        self.assertEqual(merged['HD']['SO'], 'coordinate')
+        self.assertEqual([rg['ID'] for rg in merged['RG']], rgids)
+        
+        tools.samtools.merged_header(bams[::-1] + bams, outHeader, sort_order='queryname')
+        merged = dict(pysam.AlignmentFile(outHeader, 'r', check_sq=False).header)
+        self.assertEqual(merged['HD']['SO'], 'queryname')
+        self.assertEqual([rg['ID'] for rg in merged['RG']], rgids[6:] + rgids[:6])
+
 if __name__ == '__main__':
     unittest.main()
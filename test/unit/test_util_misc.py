@@ -0,0 +1,25 @@
+# Unit tests for util.misc.py
+
+import util.misc
+import unittest
+
+class TestParallelMap(unittest.TestCase):
+    def test_preserves_order(self):
+        items = list(range(50))
+        self.assertEqual(util.misc.parallel_map(lambda x: x*x, items, threads=4),
+                         [x*x for x in items])
+
+    def test_single_thread(self):
+        self.assertEqual(util.misc.parallel_map(str, [3, 1, 2], threads=1),
+                         ['3', '1', '2'])
+
+    def test_empty(self):
+        self.assertEqual(util.misc.parallel_map(str, []), [])
+
+    def test_exception_propagates(self):
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        with self.assertRaises(ValueError):
+            util.misc.parallel_map(fail_on_three, range(6), threads=3)
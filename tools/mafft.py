@@ -86,11 +86,6 @@ class MafftTool(tools.Tool):
         # check that all sequence IDs in a file are unique
         self.__seqIdsAreAllUnique(inputFileName)
 
-        # change the pwd, since the shell script that comes with mafft depends on the pwd
-        # being correct
-        pwdBeforeMafft = os.getcwd()
-        os.chdir(os.path.dirname(self.install_and_get_path()))
-
         # build the MAFFT command
         toolCmd = [self.install_and_get_path()]
 
@@ -130,17 +125,18 @@ class MafftTool(tools.Tool):
 
         log.debug(' '.join(toolCmd))
 
-        # run the MAFFT alignment
+        # run the MAFFT alignment from the directory of the mafft binary, since the
+        # shell script that comes with mafft depends on the pwd being correct.
+        # Pass this as the child's cwd rather than calling os.chdir, so that
+        # several alignments can run concurrently from different threads.
         with open(outFile, 'w') as outf:
-            subprocess.check_call(toolCmd, stdout=outf)
+            subprocess.check_call(toolCmd, stdout=outf,
+                cwd=os.path.dirname(self.install_and_get_path()))
 
         if len(tempCombinedInputFile):
             # remove temp FASTA file
             os.unlink(tempCombinedInputFile)
 
-        # restore pwd
-        os.chdir(pwdBeforeMafft)
-
 def get_mafft_os():
     uname = os.uname()
     if uname[0] == "Darwin":
@@ -49,7 +49,7 @@ class MvicunaTool(tools.Tool) :
         log.debug(' '.join(cmdline))
         subprocess.check_call(cmdline)
         for tmpfname, outfname in zip(tmp2OutPair, outPair):
-            shutil.copyfile(tmpfname, outfname)
+            shutil.move(tmpfname, outfname)
 
 
 def _get_mvicuna_path() :
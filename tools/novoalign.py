@@ -7,11 +7,39 @@
     either in $PATH or $NOVOALIGN_PATH.
 '''
 
-import tools, tools.picard, tools.samtools, util.file
-import logging, os, os.path, subprocess, stat
+import tools, tools.picard, tools.samtools, util.file, util.misc
+import logging, os, os.path, subprocess, stat, shutil, tempfile, multiprocessing, signal
+import sys, fcntl
+import pysam
 
 log = logging.getLogger(__name__)
 
+# Bigger pipe buffers between pipeline stages mean fewer context switches
+# when Novoalign is producing SAM quickly. F_SETPIPE_SZ is Linux-only.
+PIPE_SIZE = 1 << 20
+F_SETPIPE_SZ = 1031
+
+# Most read groups split out of one input BAM in a single pass; each one
+# holds an open file and a BGZF buffer
+MAX_OPEN_BAMS = 100
+
+def _set_pipe_size(pipe, size):
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', F_SETPIPE_SZ), size)
+    except (IOError, OSError):
+        # e.g. size exceeds /proc/sys/fs/pipe-max-size; not a big deal
+        pass
+
+def _mem_to_mb(mem):
+    ''' Convert a JVM-style memory size (e.g. "2g", "512m") to megabytes. '''
+    units = {'k': 1.0/1024, 'm': 1, 'g': 1024, 't': 1024*1024}
+    mem = str(mem).strip().lower()
+    if mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(mem) // (1 << 20)
+
 class NovoalignTool(tools.Tool) :
     def __init__(self, path=None):
         self.tool_version = None
@@ -22,6 +50,9 @@ class NovoalignTool(tools.Tool) :
                     os.path.join(novopath, 'novoalign'),
                     require_executability=True))
         tools.Tool.__init__(self, install_methods = install_methods)
+        # one samtools for every call (and read group), so it only gets
+        # located/installed once
+        self.samtools = tools.samtools.SamtoolsTool()
     
     def version(self):
         if self.tool_version==None:
@@ -29,31 +60,61 @@ class NovoalignTool(tools.Tool) :
         return self.tool_version
 
     def _get_tool_version(self):
-        tmpf = util.file.mkstempfname('.novohelp.txt')
-        with open(tmpf, 'wt') as outf:
-            subprocess.call([self.install_and_get_path()], stdout=outf)
-        with open(tmpf, 'rt') as inf:
-            self.tool_version = inf.readline().strip().split()[1]
-        os.unlink(tmpf)
+        # novoalign with no arguments prints its help text (and a non-zero
+        # exit code), the first line of which contains the version
+        proc = subprocess.Popen([self.install_and_get_path()],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        out = proc.communicate()[0]
+        firstLine = out.split('\n', 1)[0].split()
+        if len(firstLine) < 2:
+            raise subprocess.CalledProcessError(proc.returncode,
+                [self.install_and_get_path()], output=out)
+        self.tool_version = firstLine[1]
+    
+    def _is_licensed(self):
+        ''' Multithreading (-c) is only available to licensed copies of
+            Novoalign, which keep novoalign.lic next to the executable.
+        '''
+        return os.path.isfile(os.path.join(
+            os.path.dirname(self.install_and_get_path()), 'novoalign.lic'))
     
     def _fasta_to_idx_name(self, fasta):
         if not fasta.endswith('.fasta'):
             raise ValueError('input file %s must end with .fasta' % fasta)
         return fasta[:-6] + '.nix'
     
+    def _prewarm_index(self, refFasta):
+        ''' Read the Novoalign index through once so that concurrent
+            Novoalign processes all start from a warm page cache instead
+            of each faulting the index in from disk.
+        '''
+        with open(self._fasta_to_idx_name(refFasta), 'rb') as inf:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(inf.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            while inf.read(1 << 20):
+                pass
+    
     def execute(self, inBam, refFasta, outBam,
-        options=["-r", "Random"], min_qual=0, JVMmemory=None):
+        options=["-r", "Random"], min_qual=0, JVMmemory=None, threads=None,
+        create_index=True):
         ''' Execute Novoalign on BAM inputs and outputs.
             If the BAM contains multiple read groups, break up
             the input and perform Novoalign separately on each one
-            (because Novoalign mangles read groups).
-            Use Picard to sort and index the output BAM.
+            (because Novoalign mangles read groups). Up to threads
+            read groups (default: number of CPUs) are aligned at once,
+            sharing the threads between them.
+            Use Samtools to sort and merge the output BAMs. JVMmemory
+            (default: what Picard SortSam used to get) caps the total
+            memory of the Samtools sorts running at once.
+            Index the output BAM unless create_index is False.
             If min_qual>0, use Samtools to filter on mapping quality.
         '''
-        samtools = tools.samtools.SamtoolsTool()
+        samtools = self.samtools
         
         # fetch list of RGs
-        rgs = list(samtools.getReadGroups(inBam).keys())
+        rgs = samtools.getReadGroups(inBam)
+        if not threads:
+            threads = multiprocessing.cpu_count()
         
         if len(rgs)==0:
             # Can't do this
@@ -61,40 +122,120 @@ class NovoalignTool(tools.Tool) :
             
         elif len(rgs) == 1:
             # Only one RG, keep it simple
-            self.align_one_rg_bam(inBam, refFasta, outBam,
-                options=options, min_qual=min_qual, JVMmemory=JVMmemory)
+            self.align_one_rg_bam(inBam, refFasta, outBam, rgs=rgs,
+                options=options, min_qual=min_qual, JVMmemory=JVMmemory,
+                threads=threads, create_index=create_index)
             
         else:
-            # Multiple RGs, align one at a time and merge
-            align_bams = []
-            for rg in rgs:
-                tmp_bam = util.file.mkstempfname('.{}.bam'.format(rg))
-                self.align_one_rg_bam(inBam, refFasta, tmp_bam,
-                    rgid=rg,
-                    options=options, min_qual=min_qual, JVMmemory=JVMmemory)
-                if os.path.getsize(tmp_bam)>0:
-                    align_bams.append(tmp_bam)
-            
-            # Merge BAMs, sort, and index
-            tools.picard.MergeSamFilesTool().execute(
-                align_bams, outBam,
-                picardOptions=['SORT_ORDER=coordinate',
-                    'USE_THREADING=true', 'CREATE_INDEX=true'],
-                JVMmemory=JVMmemory)
-            for bam in align_bams:
-                os.unlink(bam)
+            # Multiple RGs, align them concurrently and merge.
+            # Install everything up front so the workers don't race to do it.
+            self.install_and_get_path()
+            samtools.install_and_get_path()
+            # Split the input by read group in one pass rather than
+            # rescanning the whole BAM once per read group.
+            tmpDir = tempfile.mkdtemp(prefix='novoalign-')
+            try:
+                rg_bams = self._split_bam_by_rg(inBam, outDir=tmpDir)
+                nWorkers = max(1, min(len(rg_bams), threads))
+                threadsPerWorker = max(1, threads // nWorkers)
+                memPerWorker = '{}m'.format(max(1, _mem_to_mb(
+                    JVMmemory or tools.picard.SortSamTool.jvmMemDefault) // nWorkers))
+                if nWorkers > 1:
+                    self._prewarm_index(refFasta)
+                def align_rg(rg_and_bam):
+                    rg, rg_bam = rg_and_bam
+                    tmp_bam = util.file.mkstempfname('.{}.bam'.format(rg), dir=tmpDir)
+                    self.align_one_rg_bam(rg_bam, refFasta, tmp_bam,
+                        rgid=rg, rgs={rg: rgs[rg]},
+                        options=options, min_qual=min_qual, JVMmemory=memPerWorker,
+                        threads=threadsPerWorker, create_index=False)
+                    os.unlink(rg_bam)
+                    return tmp_bam
+                align_bams = util.misc.parallel_map(align_rg, rg_bams, threads=nWorkers)
+                
+                # Merge the (already sorted) BAMs and index
+                if not align_bams:
+                    # no read group has any reads: output an empty BAM, as
+                    # the single read group case would, with the input header
+                    samtools.view(['-b', '-H'], inBam, outBam)
+                elif len(align_bams) == 1:
+                    # nothing to merge with, just move it into place
+                    shutil.move(align_bams[0], outBam)
+                else:
+                    samtools.merge(align_bams, outBam, threads=threads)
+                if create_index:
+                    samtools.index(outBam, os.path.splitext(outBam)[0] + '.bai')
+            finally:
+                shutil.rmtree(tmpDir)
+    
+    def _split_bam_by_rg(self, inBam, rgids=None, outDir=None):
+        ''' Split inBam into one BAM per read group. Each output's header
+            carries only its own @RG line. If rgids is given, only those
+            read groups are written out. Files are created in outDir
+            (default: the usual temp dir). Returns a list of (RG ID, BAM
+            file) for the read groups that contain any reads.
+            Each pass over inBam writes up to MAX_OPEN_BAMS read groups at
+            once, to stay well below the open file limit.
+        '''
+        inb = pysam.AlignmentFile(inBam, 'rb', check_sq=False)
+        header = dict(inb.header)
+        inb.close()
+        rgs = [rg for rg in header.get('RG', [])
+            if rgids is None or rg['ID'] in rgids]
+        outFiles = []
+        for i in range(0, len(rgs), MAX_OPEN_BAMS):
+            outFiles.extend(self._split_bam_by_rg_pass(inBam, header,
+                rgs[i:i+MAX_OPEN_BAMS], outDir))
+        return outFiles
+    
+    def _split_bam_by_rg_pass(self, inBam, header, rgs, outDir):
+        ''' One pass of _split_bam_by_rg, over the read groups in rgs. '''
+        outFiles = []
+        outBams = {}
+        counts = {}
+        for rg in rgs:
+            rgHeader = dict(header)
+            rgHeader['RG'] = [rg]
+            fname = util.file.mkstempfname('.{}.in.bam'.format(rg['ID']), dir=outDir)
+            outFiles.append((rg['ID'], fname))
+            outBams[rg['ID']] = pysam.AlignmentFile(fname, 'wb', header=rgHeader)
+            counts[rg['ID']] = 0
+        inb = pysam.AlignmentFile(inBam, 'rb', check_sq=False)
+        for read in inb:
+            try:
+                rgid = read.opt('RG')
+            except KeyError:
+                continue
+            if rgid in outBams:
+                outBams[rgid].write(read)
+                counts[rgid] += 1
+        inb.close()
+        for outb in outBams.values():
+            outb.close()
+        for rgid, fname in outFiles:
+            if not counts[rgid]:
+                os.unlink(fname)
+        return [(rgid, fname) for rgid, fname in outFiles if counts[rgid]]
     
     def align_one_rg_bam(self, inBam, refFasta, outBam,
-        rgid=None, options=["-r", "Random"], min_qual=0, JVMmemory=None):
+        rgid=None, options=["-r", "Random"], min_qual=0, JVMmemory=None,
+        rgs=None, threads=1, create_index=True):
         ''' Execute Novoalign on BAM inputs and outputs.
             Requires that only one RG exists (will error otherwise).
-            Use Picard to sort and index the output BAM.
+            rgs, if given, is inBam's read groups as already returned by
+            SamtoolsTool.getReadGroups, to save re-reading the header.
+            Novoalign (if licensed) and Samtools sort each get threads
+            threads. JVMmemory (default: what Picard SortSam used to get)
+            is the memory limit of Samtools sort, shared between its
+            threads. Use Samtools to index the output BAM (unless
+            create_index is False).
             If min_qual>0, use Samtools to filter on mapping quality.
         '''
-        samtools = tools.samtools.SamtoolsTool()
+        samtools = self.samtools
         
         # Require exactly one RG
-        rgs = samtools.getReadGroups(inBam)
+        if rgs is None:
+            rgs = samtools.getReadGroups(inBam)
         if len(rgs)==0:
             raise InvalidBamHeaderError("{} lacks read groups".format(inBam))
         elif len(rgs) == 1:
@@ -110,73 +251,109 @@ class NovoalignTool(tools.Tool) :
                 inBam, rgid))
         rg = rgs[rgid]
         
-        # Strip inBam to just one RG (if necessary)
-        if len(rgs)==1:
-            one_rg_inBam = inBam
-        else:
-            # strip inBam to one read group
-            tmp_bam = util.file.mkstempfname('.onebam.bam')
-            samtools.view(['-b', '-r', rgid], inBam, tmp_bam)
-            # special exit if this file is empty
-            if samtools.count(tmp_bam)==0:
-                return
-            # simplify BAM header otherwise Novoalign gets confused
-            one_rg_inBam = util.file.mkstempfname('.{}.in.bam'.format(rgid))
-            headerFile = util.file.mkstempfname('.{}.header.txt'.format(rgid))
-            with open(headerFile, 'wt') as outf:
-                for row in samtools.getHeader(inBam):
-                    if len(row)>0 and row[0]=='@RG':
-                        if rgid != list(x[3:] for x in row if x.startswith('ID:'))[0]:
-                            # skip all read groups that are not rgid
-                            continue
-                    outf.write('\t'.join(row)+'\n')
-            samtools.reheader(tmp_bam, headerFile, one_rg_inBam)
-            os.unlink(tmp_bam)
-            os.unlink(headerFile)
-        
-        # Novoalign
-        tmp_sam = util.file.mkstempfname('.novoalign.sam')
-        cmd = [self.install_and_get_path(), '-f', one_rg_inBam] + list(map(str, options))
-        cmd = cmd + ['-F', 'BAMPE', '-d', self._fasta_to_idx_name(refFasta), '-o', 'SAM']
-        log.debug(' '.join(cmd))
-        with open(tmp_sam, 'wt') as outf:
-            subprocess.check_call(cmd, stdout=outf)
-        
-        # Samtools filter (optional)
-        if min_qual:
-            tmp_bam2 = util.file.mkstempfname('.filtered.bam')
-            cmd = [samtools.install_and_get_path(), 'view', '-b', '-S', '-1', '-q', str(min_qual), tmp_sam]
-            log.debug('%s > %s', ' '.join(cmd), tmp_bam2)
-            with open(tmp_bam2, 'wb') as outf:
-                subprocess.check_call(cmd, stdout=outf)
-            os.unlink(tmp_sam)
-            tmp_sam = tmp_bam2
-        
-        # Picard SortSam
-        sorter = tools.picard.SortSamTool()
-        sorter.execute(tmp_sam, outBam, sort_order='coordinate',
-            picardOptions=['CREATE_INDEX=true', 'VALIDATION_STRINGENCY=SILENT'],
-            JVMmemory=JVMmemory)
-        
-
-    def index_fasta(self, refFasta):
+        # All of our intermediates go in one directory that is removed
+        # even if something below fails
+        tmpDir = tempfile.mkdtemp(prefix='novoalign-')
+        try:
+            # Strip inBam to just one RG (if necessary)
+            if len(rgs)==1:
+                one_rg_inBam = inBam
+            else:
+                # strip inBam to one read group, with a simplified BAM header
+                # (otherwise Novoalign gets confused)
+                rg_bams = self._split_bam_by_rg(inBam, rgids=[rgid], outDir=tmpDir)
+                # special exit if this read group is empty
+                if not rg_bams:
+                    return
+                one_rg_inBam = rg_bams[0][1]
+            
+            # Novoalign, streamed straight through samtools view (SAM->BAM and
+            # optional quality filter) into samtools sort, so the aligned SAM
+            # never touches disk
+            cmd = [self.install_and_get_path(), '-f', one_rg_inBam] + list(map(str, options))
+            cmd = cmd + ['-F', 'BAMPE', '-d', self._fasta_to_idx_name(refFasta), '-o', 'SAM']
+            if threads > 1 and '-c' not in cmd and self._is_licensed():
+                cmd = cmd + ['-c', str(threads)]
+            procs = [cmd]
+            cmd = [samtools.install_and_get_path(), 'view', '-b', '-S', '-u']
+            if min_qual:
+                cmd = cmd + ['-q', str(min_qual)]
+            procs.append(cmd + ['-'])
+            
+            # Samtools sort (samtools 0.1.19 takes an output prefix, not a file name)
+            if outBam.endswith('.bam'):
+                sortPrefix = outBam[:-4]
+            else:
+                sortPrefix = os.path.join(tmpDir, 'sorted')
+            # samtools sort -m is per thread
+            sortMem = _mem_to_mb(JVMmemory or tools.picard.SortSamTool.jvmMemDefault)
+            cmd = [samtools.install_and_get_path(), 'sort',
+                '-m', '{}M'.format(max(1, sortMem // threads))]
+            if threads > 1:
+                cmd = cmd + ['-@', str(threads)]
+            procs.append(cmd + ['-', sortPrefix])
+            
+            log.debug(' | '.join(' '.join(cmd) for cmd in procs))
+            pipe = None
+            for i, cmd in enumerate(procs):
+                last = i == len(procs)-1
+                proc = subprocess.Popen(cmd, stdin=pipe,
+                    stdout=None if last else subprocess.PIPE)
+                if not last:
+                    _set_pipe_size(proc.stdout, PIPE_SIZE)
+                if pipe:
+                    # let the upstream process see SIGPIPE if we fail downstream
+                    pipe.close()
+                pipe = proc.stdout
+                procs[i] = (cmd, proc)
+            for cmd, proc in procs:
+                proc.wait()
+            # like bash's pipefail, but blame the stage that actually broke
+            # rather than an upstream one that was only killed by SIGPIPE
+            failed = [(cmd, proc) for cmd, proc in procs if proc.returncode]
+            failed.sort(key=lambda x: x[1].returncode == -signal.SIGPIPE)
+            if failed:
+                cmd, proc = failed[0]
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            if not outBam.endswith('.bam'):
+                shutil.move(sortPrefix + '.bam', outBam)
+            
+            if create_index:
+                samtools.index(outBam, os.path.splitext(outBam)[0] + '.bai')
+        finally:
+            shutil.rmtree(tmpDir)
+    
+    def index_fasta(self, refFasta, overwrite=False):
         ''' Index a FASTA file (reference genome) for use with Novoalign.
             The input file name must end in ".fasta". This will create a
-            new ".nix" file in the same directory. If it already exists,
-            it will be deleted and regenerated.
+            new ".nix" file in the same directory. If it already exists
+            and is newer than the FASTA, it is left alone (unless
+            overwrite is set); otherwise it is deleted and regenerated.
         '''
         novoindex = os.path.join(os.path.dirname(self.install_and_get_path()), 'novoindex')
         outfname = self._fasta_to_idx_name(refFasta)
         if os.path.isfile(outfname):
-            os.unlink(outfname)
-        cmd = [novoindex, outfname, refFasta]
+            if not overwrite and os.path.getmtime(outfname) >= os.path.getmtime(refFasta):
+                log.info("%s is up to date, not reindexing", outfname)
+                return
+        # build under a temporary name so that a failed or killed novoindex
+        # never leaves a truncated index that looks up to date
+        tmpfname = util.file.mkstempfname('.nix', dir=os.path.dirname(os.path.abspath(outfname)))
+        os.unlink(tmpfname)     # novoindex gets a fresh path, as before
+        cmd = [novoindex, tmpfname, refFasta]
         log.debug(' '.join(cmd))
-        subprocess.check_call(cmd)
         try:
-            mode = os.stat(outfname).st_mode & ~stat.S_IXUSR & ~stat.S_IXGRP & ~stat.S_IXOTH
-            os.chmod(outfname, mode)
+            subprocess.check_call(cmd)
+        except:
+            if os.path.isfile(tmpfname):
+                os.unlink(tmpfname)
+            raise
+        try:
+            mode = os.stat(tmpfname).st_mode & ~stat.S_IXUSR & ~stat.S_IXGRP & ~stat.S_IXOTH
+            os.chmod(tmpfname, mode)
         except (IOError, OSError):
             pass
+        os.rename(tmpfname, outfname)
 
 
 class InvalidBamHeaderError(ValueError):
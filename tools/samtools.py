@@ -10,12 +10,16 @@
     Current bug with pysam 0.8.1: nosetests does not work unless you use --nocapture.
     python -m unittest works. Something about redirecting stdout.
     Actually, Travis CI still has issues with pysam and stdout even with --nocapture.
+    
+    So samtools commands here always run the samtools binary, never pysam's
+    samtools dispatch. pysam is only used to read and write BAM headers
+    directly (see merged_header), which does not touch stdout.
 '''
 
 import logging, tools, util.file
 import os, os.path, subprocess
 from collections import OrderedDict
-#import pysam
+import pysam
 
 tool_version = '0.1.19'
 url = 'http://sourceforge.net/projects/samtools/files/samtools/' \
@@ -51,18 +55,41 @@ class SamtoolsTool(tools.Tool) :
         if stderr:
             stderr.close()
 
-    def view(self, args, inFile, outFile, regions=[]):
+    def view(self, args, inFile, outFile, regions=[], threads=None):
+        if threads and threads > 1:
+            # extra BGZF compression threads; only helps with BAM output
+            args = ['-@', str(threads)] + args
         self.execute('view', args + ['-o', outFile, inFile] + regions)
     
-    def merge(self, inFiles, outFile, options=['-f']):
-        "Merge a list of inFiles to create outFile."
+    def merge(self, inFiles, outFile, options=['-f'], threads=None):
+        ''' Merge a list of inFiles to create outFile. This samtools version
+            keeps only the first input's header, so unless options already
+            supply one with -h, merge with a header that declares the @RG
+            lines of every input (see merged_header).
+        '''
         # We are using -f for now because mkstempfname actually makes an empty
         # file, and merge fails with that as output target without the -f.
         # When mkstempfname is fixed, we should remove the -f.
+        if not inFiles:
+            raise ValueError("no input files to merge into {}".format(outFile))
+        headerFile = None
+        if '-h' not in options:
+            headerFile = util.file.mkstempfname('.header.sam')
+            merged_header(inFiles, headerFile,
+                sort_order='queryname' if '-n' in options else 'coordinate')
+            options = options + ['-h', headerFile]
+        if threads and threads > 1:
+            options = ['-@', str(threads)] + options
         self.execute('merge', options + [outFile] + inFiles)
+        if headerFile:
+            os.unlink(headerFile)
     
-    def index(self, inBam):
-        self.execute('index', [inBam])
+    def index(self, inBam, outIndex=None):
+        ''' Index a sorted BAM. outIndex defaults to samtools' naming
+            (foo.bam -> foo.bam.bai); pass foo.bai for Picard's.
+        '''
+        # run the binary, not pysam.index: see the pysam note above
+        self.execute('index', [inBam] + ([outIndex] if outIndex else []))
     
     def faidx(self, inFasta, overwrite=False):
         ''' Index reference genome for samtools '''
@@ -102,9 +129,13 @@ class SamtoolsTool(tools.Tool) :
             and not stripped out. ID is required for all read groups.
             Resulting keys are in same order as @RG lines in bam file.
         '''
-        rgs = [dict(x.split(':', 1) for x in row[1:])
-            for row in self.getHeader(inBam)
-            if len(row)>0 and row[0]=='@RG']
+        # only split the @RG lines, not the (often much longer) @SQ section
+        tmpf = util.file.mkstempfname('.txt')
+        self.dumpHeader(inBam, tmpf)
+        with open(tmpf, 'rt') as inf:
+            rgs = [dict(x.split(':', 1) for x in line.rstrip('\n').split('\t')[1:])
+                for line in inf if line.startswith('@RG\t')]
+        os.unlink(tmpf)
         return OrderedDict((rg['ID'], rg) for rg in rgs)
     
     def count(self, inBam, opts=[], regions=[]):
@@ -116,3 +147,28 @@ class SamtoolsTool(tools.Tool) :
         self.execute('mpileup', opts + [inBam], stdout = outPileup,
                      stderr = '/dev/null') # Suppress info messages
 
+
+def merged_header(inBams, outHeader, sort_order='coordinate'):
+    ''' Write a SAM header for the merge of inBams: the first file's header
+        with the @RG lines of all of them (each read group ID once, in
+        order of first appearance) and the given sort order.
+    '''
+    if not inBams:
+        raise ValueError("no BAM files to build a merged header from")
+    header = None
+    rgs = []
+    seen = set()
+    for bam in inBams:
+        inb = pysam.AlignmentFile(bam, 'rb', check_sq=False)
+        bamHeader = dict(inb.header)
+        inb.close()
+        if header is None:
+            header = bamHeader
+        for rg in bamHeader.get('RG', []):
+            if rg['ID'] not in seen:
+                seen.add(rg['ID'])
+                rgs.append(rg)
+    if rgs:
+        header['RG'] = rgs
+    header['HD'] = dict(header.get('HD', {'VN': '1.4'}), SO=sort_order)
+    pysam.AlignmentFile(outHeader, 'wh', header=header).close()
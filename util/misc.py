@@ -1,6 +1,6 @@
 '''A few miscellaneous tools. '''
 from __future__ import division # Division of integers with / should never round!
-import itertools
+import itertools, multiprocessing, multiprocessing.pool
 
 __author__ = "dpark@broadinstitute.org"
 
@@ -76,3 +76,24 @@ def batch_iterator(iterator, batch_size) :
         yield item
         item = list(itertools.islice(it, batch_size))
 
+
+def parallel_map(func, items, threads=None):
+    ''' Apply func to each of items using a pool of threads and return the
+        results in the same order as the input. This is meant for work that
+        mostly waits on external processes (aligners, samtools, etc), where
+        threads are sufficient and nothing needs to be pickled.
+        threads defaults to the number of CPUs and is capped at len(items).
+        An exception raised by any call is re-raised in the caller.
+    '''
+    items = list(items)
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    threads = max(1, min(threads, len(items)))
+    if threads == 1:
+        return [func(x) for x in items]
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()